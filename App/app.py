@@ -1,13 +1,84 @@
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import hmac
+import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import random
+import re
+import signal
+import sys
+import tempfile
 import threading
-from datetime import datetime
-from pathlib import Path
+import time
+from http.cookies import Morsel, SimpleCookie
+from urllib.parse import urlsplit, urlunsplit
 
+import aiohttp
+import anyio.to_thread
+import orjson
 import streamlit as st
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from cachetools import LRUCache, TLRUCache, TTLCache
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 import uvicorn
-from yt_dlp import YoutubeDL
+from yarl import URL
+
+import ytdlp_worker
+from ytdlp_worker import (
+    build_meta,
+    error_headers,
+    get_cookie_jar,
+    get_instagram_metadata,
+)
+
+# ===========================================================
+# 0. Logging – records are formatted and written off the event loop
+# ===========================================================
+log = logging.getLogger("instascrape")
+
+_LOG_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+
+
+def _setup_logging():
+    """
+    Log through a QueueHandler; a background QueueListener does the
+    formatting and the blocking stdout writes. Runs once per process
+    (Streamlit re-executes this script on every rerun).
+    """
+    root = logging.getLogger()
+    if any(isinstance(h, logging.handlers.QueueHandler) for h in root.handlers):
+        return
+
+    handler = logging.StreamHandler(sys.stdout)  # where the old print()s went
+    handler.setFormatter(logging.Formatter(_LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(logging.INFO)
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    def _start_child_listener():
+        # Records still queued at fork time belong to the parent's listener
+        while not log_queue.empty():
+            log_queue.get_nowait()
+        logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True).start()
+
+    # Forked workers (API_WORKERS, yt-dlp pool) don't inherit the listener
+    # thread, so give each child its own
+    os.register_at_fork(after_in_child=_start_child_listener)
+
+
+_setup_logging()
+
 
 # ===========================================================
 # 1. CONFIG – UPDATE THESE PATHS
@@ -18,24 +89,63 @@ COOKIE_FILE_MAIN = "/tmp/www.instagram.com_cookies_main.txt"
 # Second account (Account 2) – only used as fallback on specific errors
 COOKIE_FILE_ALT = "/tmp/www.instagram.com_cookies_alt.txt"
 
+@st.cache_resource
+def _written_cookie_hashes() -> tuple[threading.Lock, dict[str, str]]:
+    """Process-wide {path: md5} of cookie files we wrote, shared by all sessions."""
+    return threading.Lock(), {}
+
+
 def write_cookie_from_secret(secret_key: str, path: str) -> bool:
     """
     Read cookie text from st.secrets[secret_key] and write it to 'path'.
-    Returns True if written, False if secret missing/empty.
+    Skips the write if this process already wrote the same content there.
+    Returns True if the cookie file is in place, False if secret missing/empty.
     """
+    lock, hashes = _written_cookie_hashes()
     value = st.secrets.get(secret_key, "")
     if not value or not str(value).strip():
         # If empty, make sure no stale file is left
-        if os.path.exists(path):
-            os.remove(path)
+        with lock:
+            if os.path.exists(path):
+                os.remove(path)
+            hashes.pop(path, None)
         return False
 
-    Path(path).write_text(value, encoding="utf-8")
+    data = str(value).encode("utf-8")
+    digest = hashlib.md5(data, usedforsecurity=False).hexdigest()
+    with lock:
+        if hashes.get(path) == digest and os.path.exists(path):
+            return True
+
+        # Write a temp file (mkstemp: 0o600, the file holds session cookies)
+        # and rename it over the old one, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".cookies-")
+        try:
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        hashes[path] = digest
     return True
 
-# ----- Create cookie files from secrets -----
-main_ok = write_cookie_from_secret("INSTAGRAM_COOKIE_MAIN", COOKIE_FILE_MAIN)
-alt_ok = write_cookie_from_secret("INSTAGRAM_COOKIE_ALT", COOKIE_FILE_ALT)
+# ----- Create cookie files from secrets (once per session, not every rerun) -----
+if not st.session_state.get("cookies_written"):
+    st.session_state["cookie_ok_main"] = write_cookie_from_secret(
+        "INSTAGRAM_COOKIE_MAIN", COOKIE_FILE_MAIN
+    )
+    st.session_state["cookie_ok_alt"] = write_cookie_from_secret(
+        "INSTAGRAM_COOKIE_ALT", COOKIE_FILE_ALT
+    )
+    # Retry on the next rerun if the main cookie is still missing
+    st.session_state["cookies_written"] = st.session_state["cookie_ok_main"]
+
+main_ok = st.session_state["cookie_ok_main"]
+alt_ok = st.session_state["cookie_ok_alt"]
 
 if not main_ok:
     # Stop early if main cookie is missing
@@ -45,18 +155,29 @@ if not main_ok:
     )
 
 # ----- Build cookie pool (main first, alt optional) -----
-cookie_pool = [COOKIE_FILE_MAIN]
+# Fixed after startup, so keep it immutable and precompute the alt check
+cookie_pool = tuple([COOKIE_FILE_MAIN] + ([COOKIE_FILE_ALT] if alt_ok else []))
+_HAS_ALT = len(cookie_pool) > 1
 
-if alt_ok:
-    cookie_pool.append(COOKIE_FILE_ALT)
-    print("[INFO] Alt Instagram cookie enabled from secrets.")
+if _HAS_ALT:
+    log.info("Alt Instagram cookie enabled from secrets.")
 else:
-    print("[INFO] No alt cookie in secrets. Running with main cookie only.")
+    log.info("No alt cookie in secrets. Running with main cookie only.")
     
 
 # ===========================================================
 # 2. Helper: Decide if we should retry with Account 2
 # ===========================================================
+_RETRY_RE = re.compile(
+    r"http error 400"
+    r"|instagram api is not granting access"
+    r"|instagram sent an empty media response"
+    r"|login session is not accepted"
+    r"|post is private/restricted",
+    re.IGNORECASE,
+)
+
+
 def should_retry_with_alt_cookie(error_text: str) -> bool:
     """
     Only retry with Account 2 for errors that look like:
@@ -64,78 +185,728 @@ def should_retry_with_alt_cookie(error_text: str) -> bool:
       - API access / empty responses
       - login / private / restricted problems
     """
-    error_text = (error_text or "").lower()
-
-    patterns = [
-        "http error 400",
-        "instagram api is not granting access",
-        "instagram sent an empty media response",
-        "login session is not accepted",
-        "post is private/restricted",
-    ]
-
-    return any(p in error_text for p in patterns)
+    return bool(error_text) and _RETRY_RE.search(error_text) is not None
 
 
 # ===========================================================
 # 3. Helper: Map raw yt-dlp errors to user-friendly messages
 # ===========================================================
-def simplify_error_message(raw: str) -> str:
-    raw_lower = (raw or "").lower()
+UNKNOWN_ERROR_MESSAGE = "Unknown error – see server logs."
 
-    if "no video formats found" in raw_lower:
-        return "No downloadable video found (might be an image, carousel, or removed)."
+# Group name -> friendly message, in priority order (first wins)
+_SIMPLIFY_MAP = {
+    "no_video": "No downloadable video found (might be an image, carousel, or removed).",
+    "private": "Post is private/restricted or the login session is not accepted.",
+    "no_data": "Unable to extract data for this URL.",
+    "broken": "yt-dlp Instagram extractor is currently broken for this URL.",
+}
+_SIMPLIFY_RANK = {name: rank for rank, name in enumerate(_SIMPLIFY_MAP)}
 
-    if "instagram sent an empty media response" in raw_lower or \
-       "instagram api is not granting access" in raw_lower or \
-       "http error 400" in raw_lower or \
-       "login session is not accepted" in raw_lower:
-        return "Post is private/restricted or the login session is not accepted."
+_SIMPLIFY_RE = re.compile(
+    r"(?P<no_video>no video formats found)"
+    r"|(?P<private>instagram sent an empty media response"
+    r"|instagram api is not granting access"
+    r"|http error 400"
+    r"|login session is not accepted)"
+    r"|(?P<no_data>unable to extract data)"
+    r"|(?P<broken>functionality for this site has been marked as broken)",
+    re.IGNORECASE,
+)
 
-    if "unable to extract data" in raw_lower:
-        return "Unable to extract data for this URL."
 
-    if "functionality for this site has been marked as broken" in raw_lower:
-        return "yt-dlp Instagram extractor is currently broken for this URL."
+def simplify_error_message(raw: str) -> str:
+    if not raw:
+        return UNKNOWN_ERROR_MESSAGE
 
-    return "Unknown error – see server logs."
+    # One pass over the string; if several patterns occur keep the
+    # highest-priority one, same as the original if/elif chain.
+    groups = [m.lastgroup for m in _SIMPLIFY_RE.finditer(raw)]
+    if not groups:
+        return UNKNOWN_ERROR_MESSAGE
+    return _SIMPLIFY_MAP[min(groups, key=_SIMPLIFY_RANK.__getitem__)]
 
 
 # ===========================================================
 # 4. Instagram Metadata Function (for a given cookie file)
 # ===========================================================
-def get_instagram_metadata(url: str, cookie_file: str) -> dict:
+# The yt-dlp code lives in ytdlp_worker.py so it can run in worker
+# processes; see that module for the cookie jars and YoutubeDL cache.
+
+
+# ===========================================================
+# 4b. Fast path – Instagram's JSON endpoint via aiohttp
+# ===========================================================
+# We only need a handful of counters, so instead of yt-dlp's full extractor
+# pipeline we GET the post's "?__a=1&__d=dis" JSON directly. yt-dlp stays as
+# the fallback whenever this fails or returns something we can't parse.
+_IG_BASE_URL = URL("https://www.instagram.com/")
+_IG_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+    ),
+    "X-IG-App-ID": "936619743392459",
+    "Accept": "application/json",
+}
+
+# Shared connection pool; one ClientSession (and cookie jar) per cookie file.
+# Both are created on the API event loop at startup.
+_CONNECTOR: aiohttp.TCPConnector | None = None
+_SESSIONS: dict[str, aiohttp.ClientSession] = {}
+_API_LOOP: asyncio.AbstractEventLoop | None = None
+
+
+def _fill_aiohttp_jar(jar: aiohttp.CookieJar, cookie_file: str) -> aiohttp.CookieJar:
+    """(Re)fill an aiohttp CookieJar from the shared in-memory cookie jar."""
+    morsels = SimpleCookie()
+    for cookie in get_cookie_jar(cookie_file):
+        if not cookie.domain.lstrip(".").endswith("instagram.com"):
+            continue
+        # Morsel.set with coded_value == value: send the file's value as-is.
+        # SimpleCookie[name] = value would re-quote already quoted values
+        # such as rur="CLN\054...".
+        morsel = Morsel()
+        morsel.set(cookie.name, cookie.value, cookie.value)
+        morsel["domain"] = cookie.domain
+        morsel["path"] = cookie.path or "/"
+        morsels[cookie.name] = morsel
+
+    jar.clear()
+    jar.update_cookies(morsels, response_url=_IG_BASE_URL)
+    return jar
+
+
+def _uploader(full_name, user_id, username):
     """
-    Fetch metadata for a single Instagram URL using the given cookie file.
-    Raises whatever yt-dlp raises; caller handles retries / error logging.
+    insta_id as get_instagram_metadata builds it: yt-dlp's uploader
+    (full_name), else uploader_id (the numeric id, as a string), else the
+    username.
     """
-    ydl_opts = {
-        "skip_download": True,
-        "quiet": True,
-        "cookiefile": cookie_file,
-    }
+    if full_name:
+        return full_name
+    if user_id:
+        return str(user_id)
+    return username
+
+
+def _parse_post_json(data: dict) -> dict:
+    """
+    Map the post JSON to our metadata dict. Handles both the current
+    {"items": [...]} shape and the older {"graphql": {"shortcode_media": ...}}.
+    Fields are picked the way yt-dlp's extractor does (view_count -> plays,
+    full_name / id -> uploader), so both paths report the same values.
+    """
+    items = data.get("items") if isinstance(data, dict) else None
+    if items:
+        item = items[0]
+        user = item.get("user") or {}
+        return build_meta(
+            plays=item.get("view_count"),
+            comments=item.get("comment_count"),
+            likes=item.get("like_count"),
+            ts=item.get("taken_at"),
+            insta_id=_uploader(user.get("full_name"), user.get("pk"), user.get("username")),
+        )
 
-    with YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
+    media = ((data.get("graphql") or {}).get("shortcode_media")) if isinstance(data, dict) else None
+    if media:
+        owner = media.get("owner") or {}
+        comments = media.get("edge_media_to_comment") or media.get("edge_media_preview_comment") or {}
+        likes = media.get("edge_media_preview_like") or media.get("edge_liked_by") or {}
+        return build_meta(
+            plays=media.get("video_view_count"),
+            comments=comments.get("count"),
+            likes=likes.get("count"),
+            ts=media.get("taken_at_timestamp"),
+            insta_id=_uploader(owner.get("full_name"), owner.get("id"), owner.get("username")),
+        )
 
-    ts = info.get("timestamp")
-    pub_date = datetime.fromtimestamp(ts).strftime("%Y-%m-%d") if ts else None
-    pub_time = datetime.fromtimestamp(ts).strftime("%H:%M:%S") if ts else None
+    raise ValueError("Unrecognised Instagram JSON response.")
 
-    return {
-        "plays": info.get("view_count"),
-        "comments": info.get("comment_count"),
-        "likes": info.get("like_count"),
-        "pub_date": pub_date,
-        "pub_time": pub_time,
-        "insta_id": info.get("uploader") or info.get("uploader_id"),
-    }
+
+def _refresh_session_jars():
+    for cookie_file, session in _SESSIONS.items():
+        _fill_aiohttp_jar(session.cookie_jar, cookie_file)
+
+
+def reload_cookie_jars() -> int:
+    """
+    Re-read every cookie file; if any changed, refresh the aiohttp sessions
+    and restart the yt-dlp worker processes so they pick up the new cookies.
+    Returns the number of jars that changed.
+    """
+    changed = ytdlp_worker.reload_cookie_jars()
+    if not changed:
+        return 0
+
+    log.info("Reloaded %d rotated cookie file(s).", changed)
+    if _API_LOOP is not None and _API_LOOP.is_running():
+        _API_LOOP.call_soon_threadsafe(_refresh_session_jars)
+    ytdlp_worker.recycle_process_pool()
+    return changed
+
+
+def _on_sighup(signum, frame):
+    # Run the reload on the event loop rather than inside the interrupted code
+    if _API_LOOP is not None and _API_LOOP.is_running():
+        _API_LOOP.call_soon_threadsafe(reload_cookie_jars)
+    else:
+        reload_cookie_jars()
+
+
+# Rotate cookies with `kill -HUP <pid>`. Signal handlers can only be set from
+# the main thread, which Streamlit scripts don't run in; use the
+# /cookies/reload route there instead. Forked API_WORKERS install it
+# themselves (see _serve_worker).
+if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGHUP, _on_sighup)
+
+
+async def fetch_meta(url: str, session: aiohttp.ClientSession) -> dict:
+    """
+    Fetch metadata for a single Instagram URL from the JSON endpoint.
+    Raises on non-200 responses (e.g. login redirects) or unknown payloads.
+    """
+    match = _IG_URL_RE.match(url)
+    if not match:
+        raise ValueError("Not an Instagram post/reel URL.")
+
+    post_url = f"https://www.instagram.com/p/{match.group(2)}/"
+    async with session.get(
+        post_url,
+        params={"__a": "1", "__d": "dis"},
+        headers=_IG_HEADERS,
+        allow_redirects=False,
+    ) as resp:
+        if resp.status != 200:
+            raise aiohttp.ClientResponseError(
+                resp.request_info,
+                resp.history,
+                status=resp.status,
+                message=f"HTTP Error {resp.status}: {resp.reason}",
+                headers=resp.headers,
+            )
+        data = await resp.json(content_type=None)
+
+    return _parse_post_json(data)
+
+
+# ===========================================================
+# 5. Concurrency – keep blocking yt-dlp calls off the event loop
+# ===========================================================
+# yt-dlp is fully blocking and its extraction is CPU-heavy, so calls run in
+# ytdlp_worker's process pool (one YoutubeDL cache per worker) while the
+# event loop keeps serving other requests. This thread pool is the fallback
+# when YTDLP_PROCESSES=0 or the process pool breaks.
+_YTDLP_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=32, thread_name_prefix="ytdlp"
+)
+
+# Global cap on yt-dlp calls in flight
+_INFLIGHT = asyncio.Semaphore(16)
+
+# Starlette threadpool size (sync routes / file IO), raised at startup
+_STARLETTE_THREAD_TOKENS = 64
+
+
+async def fetch_metadata_async(url: str, cookie_file: str) -> dict:
+    """
+    Run yt-dlp in a worker process (thread pool as fallback), bounded by
+    _INFLIGHT.
+    """
+    loop = asyncio.get_running_loop()
+    async with _INFLIGHT:
+        pool = None
+        try:
+            pool = ytdlp_worker.get_process_pool(cookie_pool)
+            if pool is not None:
+                # Workers are started on submit, so start-up failures raise here
+                return await loop.run_in_executor(
+                    pool, ytdlp_worker.extract_in_worker, url, cookie_file
+                )
+        except (concurrent.futures.BrokenExecutor, RuntimeError) as e:
+            # Crashed worker, or the pool was shut down (recycled) under us:
+            # transient, so start a fresh pool for the next request
+            if isinstance(e, RuntimeError) and "shutdown" not in str(e):
+                raise
+            log.warning("yt-dlp process pool unusable (%s); restarting it, "
+                        "using threads for this request.", e)
+            ytdlp_worker.recycle_process_pool(pool)
+        except (AssertionError, OSError) as e:
+            # Workers could not be started at all (daemonic process, fork
+            # failure): stop trying in this process
+            ytdlp_worker.disable_process_pool(e)
+
+        return await loop.run_in_executor(
+            _YTDLP_POOL, get_instagram_metadata, url, cookie_file
+        )
+
+
+async def fetch_metadata(url: str, cookie_file: str) -> dict:
+    """
+    Fast aiohttp path first; yt-dlp (in the thread pool) as fallback.
+    """
+    session = _SESSIONS.get(cookie_file)
+    if session is not None:
+        try:
+            return await fetch_meta(url, session)
+        except aiohttp.ClientResponseError as e:
+            if e.status == 429:
+                raise  # rate limited: don't hit Instagram again through yt-dlp
+            log.info("JSON fast path failed (%s); falling back to yt-dlp.", e)
+        except Exception as e:
+            log.info("JSON fast path failed (%s); falling back to yt-dlp.", e)
+
+    return await fetch_metadata_async(url, cookie_file)
+
+
+# ===========================================================
+# 5b. Rate limiting – per-cookie AIMD concurrency + request window
+# ===========================================================
+# Per-cookie request cap over the last 60 s (0 = no cap, only counted)
+COOKIE_MAX_RPM = int(os.environ.get("COOKIE_MAX_RPM", "0"))
+# Longest a request waits for a paused cookie (Retry-After / RPM cap) before
+# failing fast with CookieRateLimited, seconds
+AIMD_MAX_WAIT = 2.0
+
+
+class CookieRateLimited(Exception):
+    """The cookie is paused for longer than AIMD_MAX_WAIT; nothing was sent."""
+
+
+class AIMD:
+    """
+    Additive-increase / multiplicative-decrease concurrency limit for one
+    cookie. Halves on rate-limit style errors, grows by 0.5 per success,
+    and honours Retry-After by pausing the cookie. Waits longer than
+    max_wait raise CookieRateLimited instead of sleeping.
+    """
+
+    def __init__(self, c: float = 4.0, cmin: float = 1.0, cmax: float = 32.0,
+                 max_rpm: int = COOKIE_MAX_RPM, max_wait: float = AIMD_MAX_WAIT):
+        self.c = c
+        self.cmin = cmin
+        self.cmax = cmax
+        self.max_rpm = max_rpm
+        self.max_wait = max_wait
+        self.blocked_until = 0.0
+        self._inflight = 0
+        self._cond = asyncio.Condition()
+        self._window: collections.deque[float] = collections.deque()
+
+    def _prune(self, now: float):
+        while self._window and now - self._window[0] > 60.0:
+            self._window.popleft()
+
+    @property
+    def rpm(self) -> int:
+        self._prune(time.monotonic())
+        return len(self._window)
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._inflight < int(self.c))
+            self._inflight += 1
+
+        try:
+            deadline = time.monotonic() + self.max_wait
+            while True:
+                now = time.monotonic()
+                self._prune(now)
+                delay = self.blocked_until - now
+                if self.max_rpm and len(self._window) >= self.max_rpm:
+                    delay = max(delay, 60.0 - (now - self._window[0]))
+                if delay <= 0:
+                    break
+                if now + delay > deadline:
+                    raise CookieRateLimited(
+                        f"Cookie rate limited for another {delay:.0f} s (HTTP Error 429)."
+                    )
+                await asyncio.sleep(delay)
+        except BaseException:
+            # Cancelled or rejected while paused: __aexit__ won't run, so
+            # give the slot back
+            await self._release()
+            raise
+
+        self._window.append(time.monotonic())
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._release()
+
+    async def _release(self):
+        async with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+    def on_ok(self):
+        self.c = min(self.cmax, self.c + 0.5)
+
+    def on_err(self, retry_after: float | None = None):
+        self.c = max(self.cmin, self.c * 0.5)
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+
+def rate_limit_signal(exc: BaseException) -> tuple[bool, float | None]:
+    """
+    (is_rate_limited, retry_after_seconds) for a failed fetch.
+    429s, Instagram's HTTP 400 throttling, exhausted x-ratelimit-remaining
+    and Retry-After count; private/login errors don't.
+    """
+    headers = error_headers(exc)
+    retry_after = None
+    exhausted = False
+    if headers is not None:
+        try:
+            retry_after = float(headers.get("retry-after") or 0) or None
+        except (TypeError, ValueError):
+            retry_after = None
+        exhausted = str(headers.get("x-ratelimit-remaining", "")).strip() == "0"
+
+    raw = str(exc)
+    limited = (
+        getattr(exc, "status", None) in (400, 429)
+        or _RATE_LIMIT_RE.search(raw) is not None
+        or exhausted
+        or retry_after is not None
+    )
+    return limited, retry_after
+
+
+_RATE_LIMIT_RE = re.compile(r"http error (?:400|429)", re.IGNORECASE)
+
+# Short-lived failures worth retrying on the same cookie
+_TRANSIENT_RE = re.compile(
+    r"http error (?:429|5\d\d)"
+    r"|timed out|timeout"
+    r"|temporarily unavailable"
+    r"|connection (?:reset|aborted|refused)",
+    re.IGNORECASE,
+)
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    """429s, 5xx responses, timeouts and dropped connections."""
+    if isinstance(exc, CookieRateLimited):
+        # Retrying would only wait out the same pause again
+        return False
+    status = getattr(exc, "status", None)
+    if isinstance(status, int) and (status == 429 or 500 <= status < 600):
+        return True
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError,
+                        aiohttp.ClientConnectionError)):
+        return True
+    return _TRANSIENT_RE.search(str(exc)) is not None
+
+
+# One controller per cookie index so the alt account has its own budget
+_BUDGETS = {idx: AIMD() for idx in range(len(cookie_pool))}
+
+# Attempts on the main cookie before escalating to the alt one
+MAIN_COOKIE_ATTEMPTS = 3
+
+
+async def _fetch_with_budget(url: str, cookie_idx: int, cookie_file: str) -> dict:
+    """fetch_metadata under the cookie's AIMD budget, feeding back the outcome."""
+    budget = _BUDGETS[cookie_idx]
+    try:
+        async with budget:
+            meta = await fetch_metadata(url, cookie_file)
+    except CookieRateLimited:
+        raise  # rejected before sending: no new signal for the controller
+    except Exception as e:
+        limited, retry_after = rate_limit_signal(e)
+        if limited:
+            budget.on_err(retry_after)
+            log.warning("Cookie #%d rate limited: concurrency -> %g, %d req in last 60 s.",
+                        cookie_idx, budget.c, budget.rpm)
+        raise
+
+    budget.on_ok()
+    return meta
+
+
+async def _with_backoff(coro_fn, attempts: int = MAIN_COOKIE_ATTEMPTS):
+    """
+    Await coro_fn(), retrying transient errors (is_transient_error) with
+    full-jitter exponential backoff (sleep up to 0.5 s, 1 s, 2 s, ...).
+    Other errors, e.g. private posts, raise at once.
+    """
+    for i in range(attempts):
+        try:
+            return await coro_fn()
+        except Exception as e:
+            if i == attempts - 1 or not is_transient_error(e):
+                raise
+            await asyncio.sleep(random.uniform(0, 2 ** i * 0.5))
+
+
+# Scrape results per (normalized URL, cookie index). Counts barely move
+# within a few minutes, so repeated POSTs for the same link are served
+# from memory instead of hitting Instagram again.
+META_TTL = 300
+# Plays/likes/comments only grow, so a fresh scrape with a lower counter is
+# treated as stale (blocked/partial response): the previous result is kept
+# for this much longer instead. After _MAX_KEEPS in a row we accept the new one.
+META_KEEP_TTL = 900
+_MAX_KEEPS = 3
+_MONOTONIC_FIELDS = ("plays", "likes", "comments")
+
+# Entries are (meta, ttl) so kept results can outlive fresh ones
+_META_CACHE = TLRUCache(maxsize=4096, ttu=lambda key, value, now: now + value[1])
+# Last accepted result per key as (meta, consecutive_keeps); outlives expiry
+_LAST_META = LRUCache(maxsize=4096)
+_CACHE_STATS = {"kept": 0, "replaced": 0}
+# Short-lived negative cache for known (classified) errors
+_ERROR_CACHE = TTLCache(maxsize=4096, ttl=30)
+_CACHE_LOCK = threading.RLock()
+
+
+class CachedScrapeError(Exception):
+    """Raised when a recent identical scrape already failed."""
+
+
+# Post/reel/IGTV URLs, optionally with a leading "<username>/" segment.
+# The shortcode must be the last path segment and the first segment can't
+# be a reserved page, so e.g. /reels/audio/<id>/ or /explore/... don't match.
+_IG_URL_RE = re.compile(
+    r"^https?://(?:www\.|m\.)?instagram\.com/"
+    r"(?!(?:about|accounts|audio|direct|explore|legal|stories)/)"
+    r"(?:[A-Za-z0-9_.]+/)?(reels?|p|tv)/([A-Za-z0-9_-]+)/?(?:[?#]|$)",
+    re.IGNORECASE,
+)
+
+
+def canonicalize(url: str) -> str | None:
+    """
+    Minimal form of an Instagram post URL, e.g.
+      "https://instagram.com/reel/ABC123/?igshid=xyz" -> "https://www.instagram.com/reel/ABC123/"
+    Returns None for anything that isn't a post/reel/tv URL.
+    """
+    match = _IG_URL_RE.match(url.strip())
+    if not match:
+        return None
+    kind = match.group(1).lower()
+    if kind == "reels":
+        kind = "reel"
+    return f"https://www.instagram.com/{kind}/{match.group(2)}/"
+
+
+def normalize_url(url: str) -> str:
+    """
+    Cache key for a URL: its canonical form for Instagram posts, otherwise
+    the URL without query string, fragment and trailing '/', so
+    '?igshid=...' variants of the same post share a cache entry.
+    """
+    canonical = canonicalize(url)
+    if canonical is not None:
+        return canonical
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path.rstrip("/"), "", ""))
+
+
+def _counters_dropped(new: dict, old: dict) -> bool:
+    return any(
+        new.get(f) is not None and old.get(f) is not None and new[f] < old[f]
+        for f in _MONOTONIC_FIELDS
+    )
+
+
+def _store_meta(key, meta: dict) -> dict:
+    """
+    Insert a fresh scrape unless it looks staler than the last accepted one.
+    Returns whichever result is now cached.
+    """
+    with _CACHE_LOCK:
+        prev, keeps = _LAST_META.get(key, (None, 0))
+        if prev is not None and keeps < _MAX_KEEPS and _counters_dropped(meta, prev):
+            _META_CACHE[key] = (prev, META_KEEP_TTL)
+            _LAST_META[key] = (prev, keeps + 1)
+            _CACHE_STATS["kept"] += 1
+            result = prev
+        else:
+            _META_CACHE[key] = (meta, META_TTL)
+            _LAST_META[key] = (meta, 0)
+            _CACHE_STATS["replaced"] += 1
+            result = meta
+
+        total = _CACHE_STATS["kept"] + _CACHE_STATS["replaced"]
+        if total % 100 == 0:
+            log.info("Scrape cache: kept %d / replaced %d of %d inserts.",
+                     _CACHE_STATS["kept"], _CACHE_STATS["replaced"], total)
+    return result
+
+
+async def fetch_metadata_cached(url: str, cookie_idx: int, cookie_file: str) -> dict:
+    """
+    fetch_metadata with the TTL cache in front of it.
+    Raises CachedScrapeError for links that failed with a known error recently.
+    """
+    key = (normalize_url(url), cookie_idx)
+
+    with _CACHE_LOCK:
+        entry = _META_CACHE.get(key)
+        cached_error = _ERROR_CACHE.get(key)
+    if entry is not None:
+        return entry[0]
+    if cached_error is not None:
+        raise CachedScrapeError(cached_error)
+
+    # Back off on transient errors on the main cookie before the caller moves to alt
+    attempts = MAIN_COOKIE_ATTEMPTS if cookie_idx == 0 else 1
+    try:
+        meta = await _with_backoff(
+            lambda: _fetch_with_budget(url, cookie_idx, cookie_file), attempts
+        )
+    except Exception as e:
+        raw = str(e)
+        if simplify_error_message(raw) != UNKNOWN_ERROR_MESSAGE:
+            with _CACHE_LOCK:
+                _ERROR_CACHE[key] = raw
+        raise
+
+    return _store_meta(key, meta)
+
+
+def invalidate_cache(url: str | None = None) -> int:
+    """
+    Drop cached results for one URL (all cookies), or everything if url is None.
+    Returns the number of entries removed.
+    """
+    with _CACHE_LOCK:
+        if url is None:
+            removed = len(_META_CACHE) + len(_ERROR_CACHE)
+            _META_CACHE.clear()
+            _ERROR_CACHE.clear()
+            _LAST_META.clear()
+            return removed
+
+        target = normalize_url(url)
+        removed = 0
+        for cache in (_META_CACHE, _ERROR_CACHE):
+            for key in [k for k in cache.keys() if k[0] == target]:
+                cache.pop(key, None)
+                removed += 1
+        for key in [k for k in _LAST_META.keys() if k[0] == target]:
+            _LAST_META.pop(key, None)
+        return removed
+
+
+async def try_fetch(link: str) -> tuple[dict | None, str | None]:
+    """
+    Fetch metadata for one link: main account first, alt account only for
+    retry-worthy errors. Returns (meta, None) on success, (None, raw_error)
+    otherwise. Used by the FastAPI route and the Streamlit manual test
+    (the latter with its own per-rerun state, see below).
+    """
+    last_error_raw = None
+
+    for cookie_idx, cookie_file in enumerate(cookie_pool):
+        try:
+            return await fetch_metadata_cached(link, cookie_idx, cookie_file), None
+        except Exception as e:
+            last_error_raw = str(e)
+            # Try alt cookie only if we are on main cookie and error is
+            # "retry-worthy" (or main is paused by its rate limiter)
+            retry_worthy = (isinstance(e, CookieRateLimited)
+                            or should_retry_with_alt_cookie(last_error_raw))
+            if cookie_idx == 0 and _HAS_ALT and retry_worthy:
+                continue  # try next cookie
+            break  # not retry-worthy or already using alt cookie
+
+    return None, last_error_raw
 
 
 # ===========================================================
 # 6. FastAPI app – this is what Apps Script calls
 # ===========================================================
-api = FastAPI()
+# Error bodies never change, so they are encoded once at import
+_EMPTY = {
+    "plays": "",
+    "comments": "",
+    "likes": "",
+    "pub_date": "",
+    "pub_time": "",
+    "insta_id": "",
+}
+
+
+def _encode_error(message: str) -> bytes:
+    return orjson.dumps({**_EMPTY, "error": message})
+
+
+_ERR_INVALID_JSON = _encode_error("Invalid JSON body.")
+_ERR_NO_LINK = _encode_error("No link provided.")
+_ERR_BAD_URL = _encode_error("Not a valid Instagram post/reel URL.")
+_ERR_NO_COOKIES = _encode_error("No valid Instagram cookie files found on server.")
+_ERR_FRIENDLY = {
+    message: _encode_error(message)
+    for message in (*_SIMPLIFY_MAP.values(), UNKNOWN_ERROR_MESSAGE)
+}
+
+
+def _error_response(content: bytes, status_code: int) -> Response:
+    return Response(content=content, media_type="application/json", status_code=status_code)
+
+
+# Shared secret for the admin routes, sent as the X-Admin-Token header.
+# Without one, admin routes only answer requests from this machine.
+ADMIN_TOKEN = str(st.secrets.get("ADMIN_TOKEN", "") or "")
+_LOOPBACK_HOSTS = frozenset({"127.0.0.1", "::1", "localhost"})
+
+
+def _admin_denied(request: Request) -> Response | None:
+    """403 response unless the request may use the admin routes, else None."""
+    if ADMIN_TOKEN:
+        token = request.headers.get("x-admin-token", "")
+        allowed = hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+    else:
+        allowed = request.client is not None and request.client.host in _LOOPBACK_HOSTS
+    if allowed:
+        return None
+    return ORJSONResponse({"error": "Forbidden."}, status_code=403)
+
+
+async def _open_http_sessions():
+    global _CONNECTOR, _API_LOOP
+    _API_LOOP = asyncio.get_running_loop()
+    _CONNECTOR = aiohttp.TCPConnector(limit=256, limit_per_host=64, ttl_dns_cache=300)
+
+    for cookie_file in cookie_pool:
+        try:
+            jar = _fill_aiohttp_jar(aiohttp.CookieJar(), cookie_file)
+        except Exception as e:
+            log.warning("Could not load %s for the JSON fast path: %s", cookie_file, e)
+            continue
+        _SESSIONS[cookie_file] = aiohttp.ClientSession(
+            connector=_CONNECTOR,
+            connector_owner=False,
+            cookie_jar=jar,
+        )
+
+
+async def _close_http_sessions():
+    for session in _SESSIONS.values():
+        await session.close()
+    _SESSIONS.clear()
+    if _CONNECTOR is not None:
+        await _CONNECTOR.close()
+
+
+@contextlib.asynccontextmanager
+async def _lifespan(app: FastAPI):
+    """Startup/shutdown of the API: thread limiter and the aiohttp sessions."""
+    anyio.to_thread.current_default_thread_limiter().total_tokens = _STARLETTE_THREAD_TOKENS
+    await _open_http_sessions()
+    try:
+        yield
+    finally:
+        await _close_http_sessions()
+
+
+api = FastAPI(default_response_class=ORJSONResponse, lifespan=_lifespan)
 
 
 @api.post("/instagram-metadata")
@@ -155,83 +926,40 @@ async def instagram_metadata(request: Request):
         "error": <str or ''>
       }
     """
+    # Obviously empty request: nothing to read or parse
+    if request.headers.get("content-length") == "0":
+        return _error_response(_ERR_NO_LINK, status_code=400)
+
     try:
-        body = await request.json()
-    except Exception:
-        return JSONResponse(
-            {
-                "plays": "",
-                "comments": "",
-                "likes": "",
-                "pub_date": "",
-                "pub_time": "",
-                "insta_id": "",
-                "error": "Invalid JSON body.",
-            },
-            status_code=400,
-        )
+        raw = await request.body()
+        body = orjson.loads(raw) if raw else {}
+    except orjson.JSONDecodeError:
+        return _error_response(_ERR_INVALID_JSON, status_code=400)
+
+    if not isinstance(body, dict):
+        return _error_response(_ERR_INVALID_JSON, status_code=400)
 
-    link = (body.get("link") or "").strip()
+    link = body.get("link")
+    link = link.strip() if isinstance(link, str) else ""
 
     if not link:
-        return JSONResponse(
-            {
-                "plays": "",
-                "comments": "",
-                "likes": "",
-                "pub_date": "",
-                "pub_time": "",
-                "insta_id": "",
-                "error": "No link provided.",
-            },
-            status_code=400,
-        )
+        return _error_response(_ERR_NO_LINK, status_code=400)
+
+    # Reject garbage before it reaches the cache or yt-dlp
+    link = canonicalize(link)
+    if link is None:
+        return _error_response(_ERR_BAD_URL, status_code=400)
 
     # If no cookies at all, fail fast
     if not cookie_pool:
-        return JSONResponse(
-            {
-                "plays": "",
-                "comments": "",
-                "likes": "",
-                "pub_date": "",
-                "pub_time": "",
-                "insta_id": "",
-                "error": "No valid Instagram cookie files found on server.",
-            },
-            status_code=500,
-        )
-
-    last_error_raw = None
-    success = False
-    meta = None
+        return _error_response(_ERR_NO_COOKIES, status_code=500)
 
-    # Try main account first; only try alt account if specific types of errors occur
-    for cookie_idx, cookie_file in enumerate(cookie_pool):
-        try:
-            meta = get_instagram_metadata(link, cookie_file)
-            success = True
-            break  # success, no need to try others
-        except Exception as e:
-            last_error_raw = str(e)
-            # Try alt cookie only if we are on main cookie and error is "retry-worthy"
-            if cookie_idx == 0 and len(cookie_pool) > 1 and should_retry_with_alt_cookie(last_error_raw):
-                continue  # try next cookie
-            else:
-                break  # not retry-worthy or already using alt cookie
+    meta, last_error_raw = await try_fetch(link)
 
-    if not success:
+    if meta is None:
         friendly = simplify_error_message(last_error_raw)
-        return JSONResponse(
-            {
-                "plays": "",
-                "comments": "",
-                "likes": "",
-                "pub_date": "",
-                "pub_time": "",
-                "insta_id": "",
-                "error": friendly,
-            },
+        return _error_response(
+            _ERR_FRIENDLY[friendly],
             status_code=200,  # we return 200 so Apps Script can still read error field
         )
 
@@ -246,15 +974,135 @@ async def instagram_metadata(request: Request):
         "error": "",
     }
 
-    return JSONResponse(resp, status_code=200)
+    return ORJSONResponse(resp, status_code=200)
+
+
+@api.post("/cache/invalidate")
+async def cache_invalidate(request: Request):
+    """
+    Admin helper to bust the scrape cache.
+      { "link": "https://www.instagram.com/reel/..." }  -> drop that post only
+      {} or no body                                     -> drop everything
+    """
+    denied = _admin_denied(request)
+    if denied is not None:
+        return denied
+
+    try:
+        raw = await request.body()
+        body = orjson.loads(raw) if raw else {}
+    except orjson.JSONDecodeError:
+        return ORJSONResponse({"invalidated": 0, "error": "Invalid JSON body."}, status_code=400)
+
+    if not isinstance(body, dict):
+        return ORJSONResponse({"invalidated": 0, "error": "Invalid JSON body."}, status_code=400)
+
+    # Only an explicitly empty request flushes everything
+    if "link" not in body:
+        removed = invalidate_cache(None)
+        return ORJSONResponse({"invalidated": removed, "error": ""}, status_code=200)
+
+    link = body["link"]
+    link = link.strip() if isinstance(link, str) else ""
+    if not link:
+        return ORJSONResponse({"invalidated": 0, "error": "No link provided."}, status_code=400)
+
+    removed = invalidate_cache(link)
+    return ORJSONResponse({"invalidated": removed, "error": ""}, status_code=200)
+
+
+@api.post("/cookies/reload")
+async def cookies_reload(request: Request):
+    """
+    Admin helper to re-read the cookie files after they were rotated.
+    With API_WORKERS > 1 only one worker receives the request; it reloads
+    itself and sends SIGHUP to the other workers so they reload too (each
+    worker only restarts anything if its own cookies changed).
+    """
+    denied = _admin_denied(request)
+    if denied is not None:
+        return denied
+
+    reloaded = reload_cookie_jars()
+    signalled = _signal_sibling_workers()
+    return ORJSONResponse(
+        {"reloaded": reloaded, "workers_signalled": signalled, "error": ""},
+        status_code=200,
+    )
 
 
 # ===========================================================
 # 7. Start FastAPI (uvicorn) in background when Streamlit runs
 # ===========================================================
+# host/port MUST match your Apps Script PYTHON_ENDPOINT
+API_HOST = "0.0.0.0"
+API_PORT = 8000
+
+# Number of uvicorn worker processes sharing the listening socket.
+# 1 (default) serves from this thread; >1 forks workers, each with its own
+# caches, to spread request handling and yt-dlp across cores. Forked
+# workers are daemonic, so they run yt-dlp in threads, not a process pool.
+API_WORKERS = max(1, min(int(os.environ.get("API_WORKERS", "1")), os.cpu_count() or 1))
+
+# PIDs of all forked API workers (shared memory), so /cookies/reload can
+# reach every worker, not just the one that took the request
+_WORKER_PIDS = None
+
+
+def _serve_worker(config: uvicorn.Config, sock, idx: int, pids):
+    """Entry point of a forked API worker."""
+    global _WORKER_PIDS
+    _WORKER_PIDS = pids
+    pids[idx] = os.getpid()
+    # The forked child runs in its own main thread, so SIGHUP can be handled
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, _on_sighup)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def _signal_sibling_workers() -> int:
+    """SIGHUP the other API workers; returns how many were signalled."""
+    if _WORKER_PIDS is None or not hasattr(signal, "SIGHUP"):
+        return 0
+
+    signalled = 0
+    for pid in _WORKER_PIDS:
+        if pid and pid != os.getpid():
+            try:
+                os.kill(pid, signal.SIGHUP)
+                signalled += 1
+            except ProcessLookupError:
+                log.warning("API worker %d is gone; could not reload its cookies.", pid)
+    return signalled
+
+
 def run_api():
-    # host/port MUST match your Apps Script PYTHON_ENDPOINT
-    uvicorn.run(api, host="0.0.0.0", port=8000, log_level="info")
+    config = uvicorn.Config(
+        api,
+        host=API_HOST,
+        port=API_PORT,
+        loop="uvloop",
+        http="httptools",
+        log_level="info",
+    )
+
+    if API_WORKERS == 1:
+        uvicorn.Server(config).run()
+        return
+
+    # We are inside a Streamlit thread, so uvicorn's own --workers supervisor
+    # is not available: bind once here and let forked workers share the socket.
+    sock = config.bind_socket()
+    ctx = multiprocessing.get_context("fork")
+    pids = ctx.Array("i", API_WORKERS, lock=False)
+    workers = [
+        ctx.Process(target=_serve_worker, args=(config, sock, idx, pids), daemon=True)
+        for idx in range(API_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
 
 
 if "api_server_started" not in st.session_state:
@@ -273,38 +1121,37 @@ st.title("Instagram Metadata Service (Streamlit + FastAPI)")
 st.write("This app runs a FastAPI endpoint at `http://localhost:8000/instagram-metadata`.")
 st.write("Your Google Apps Script can POST to this URL to fetch Instagram metrics.")
 
+@st.cache_data(ttl=30)
+def _exists(path: str) -> bool:
+    # Cached so reruns don't stat() the cookie files on every interaction
+    return os.path.exists(path)
+
+
 st.subheader("Service status")
 st.write(f"Main cookie file: `{COOKIE_FILE_MAIN}` "
-         f"({'FOUND' if os.path.exists(COOKIE_FILE_MAIN) else 'NOT FOUND'})")
+         f"({'FOUND' if _exists(COOKIE_FILE_MAIN) else 'NOT FOUND'})")
 st.write(f"Alt cookie file: `{COOKIE_FILE_ALT}` "
-         f"({'FOUND' if os.path.exists(COOKIE_FILE_ALT) else 'NOT FOUND'})")
+         f"({'FOUND' if _exists(COOKIE_FILE_ALT) else 'NOT FOUND'})")
 
 st.subheader("Manual test (local only)")
 test_url = st.text_input("Instagram Post URL:")
 
-if st.button("Test fetch (direct Python call)"):
+if st.button("Test fetch (direct Python call, yt-dlp only)"):
     if not test_url.strip():
         st.error("Please enter an Instagram URL.")
+    elif canonicalize(test_url) is None:
+        st.error("Not a valid Instagram post/reel URL.")
     else:
         try:
             # Directly call our helper (bypassing FastAPI) for quick testing.
-            last_error_raw = None
-            success = False
-            meta = None
-
-            for cookie_idx, cookie_file in enumerate(cookie_pool):
-                try:
-                    meta = get_instagram_metadata(test_url.strip(), cookie_file)
-                    success = True
-                    break
-                except Exception as e:
-                    last_error_raw = str(e)
-                    if cookie_idx == 0 and len(cookie_pool) > 1 and should_retry_with_alt_cookie(last_error_raw):
-                        continue
-                    else:
-                        break
-
-            if not success:
+            # The Streamlit script thread has no event loop, so run one here.
+            # Streamlit re-executes this script on every click, so this runs
+            # with this rerun's fresh globals: same retry/error logic, but an
+            # empty cache, fresh rate limits and no aiohttp sessions, i.e.
+            # always the yt-dlp path. It does not share the API's state.
+            meta, last_error_raw = asyncio.run(try_fetch(canonicalize(test_url)))
+
+            if meta is None:
                 friendly = simplify_error_message(last_error_raw)
                 st.error(f"Failed: {friendly}")
             else:
@@ -0,0 +1,307 @@
+"""
+yt-dlp side of the Instagram metadata service.
+
+Lives in its own module (not app.py) so the functions can be pickled into a
+ProcessPoolExecutor: Streamlit runs app.py as a throwaway __main__ module on
+every rerun, which worker processes cannot import by name.
+"""
+import atexit
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+from datetime import datetime
+
+from yt_dlp import YoutubeDL
+from yt_dlp.cookies import YoutubeDLCookieJar
+
+log = logging.getLogger("instascrape.ytdlp")
+
+# ===========================================================
+# 1. Cookie jars + long-lived YoutubeDL instances (per process)
+# ===========================================================
+# Each Netscape cookie file is parsed once into memory and shared by yt-dlp
+# and the JSON fast path. reload_cookie_jars() re-reads them after rotation.
+_COOKIE_JARS: dict[str, YoutubeDLCookieJar] = {}
+
+# One long-lived YoutubeDL per (thread, cookie file), so extractors are
+# initialised once and HTTP connections are kept alive across requests.
+# Per thread because YoutubeDL keeps per-run state on the instance and is
+# not safe to share between concurrent extract_info calls.
+_YDL_LOCAL = threading.local()
+# Every instance created in this process, so they can be closed at exit
+_YDL_INSTANCES: list[YoutubeDL] = []
+_YDL_CACHE_LOCK = threading.RLock()
+
+# Parent's YoutubeDL objects inherited by a forked worker. Kept referenced
+# (never used or closed) so garbage collection can't shut down sockets that
+# still belong to the parent.
+_INHERITED_YDL: list[YoutubeDL] = []
+
+
+def read_cookie_file(cookie_file: str) -> YoutubeDLCookieJar:
+    jar = YoutubeDLCookieJar(cookie_file)
+    jar.load(ignore_discard=True, ignore_expires=True)
+    return jar
+
+
+def get_cookie_jar(cookie_file: str) -> YoutubeDLCookieJar:
+    jar = _COOKIE_JARS.get(cookie_file)
+    if jar is None:
+        with _YDL_CACHE_LOCK:
+            jar = _COOKIE_JARS.get(cookie_file)
+            if jar is None:
+                jar = _COOKIE_JARS.setdefault(cookie_file, read_cookie_file(cookie_file))
+    return jar
+
+
+def _jar_contents(jar: YoutubeDLCookieJar) -> set[tuple]:
+    return {(c.domain, c.path, c.name, c.value, c.expires) for c in jar}
+
+
+def reload_cookie_jars() -> int:
+    """
+    Re-read every cookie file into its existing jar (yt-dlp keeps the same
+    jar object). Jars whose file is unchanged are left alone. Returns the
+    number of jars whose contents changed.
+    """
+    changed = 0
+    for cookie_file, jar in list(_COOKIE_JARS.items()):
+        try:
+            fresh = read_cookie_file(cookie_file)
+        except Exception as e:
+            log.warning("Could not reload %s: %s", cookie_file, e)
+            continue
+        if _jar_contents(fresh) == _jar_contents(jar):
+            continue
+        # Parse first, then swap contents, so a bad file leaves the jar intact
+        jar.clear()
+        for cookie in fresh:
+            jar.set_cookie(cookie)
+        changed += 1
+    return changed
+
+
+def _get_ydl(cookie_file: str) -> YoutubeDL:
+    cache = getattr(_YDL_LOCAL, "cache", None)
+    if cache is None:
+        cache = _YDL_LOCAL.cache = {}
+
+    ydl = cache.get(cookie_file)
+    if ydl is None:
+        ydl = YoutubeDL({
+            "skip_download": True,
+            "quiet": True,
+        })
+        # No "cookiefile" option: hand yt-dlp the already-parsed jar
+        ydl.cookiejar = get_cookie_jar(cookie_file)
+        cache[cookie_file] = ydl
+        with _YDL_CACHE_LOCK:
+            _YDL_INSTANCES.append(ydl)
+    return ydl
+
+
+def _close_ydl_cache():
+    with _YDL_CACHE_LOCK:
+        instances = list(_YDL_INSTANCES)
+    for ydl in instances:
+        ydl.close()
+
+
+atexit.register(_close_ydl_cache)
+
+
+# ===========================================================
+# 2. Metadata helpers
+# ===========================================================
+@functools.lru_cache(maxsize=1024)
+def _fmt_ts(ts: int) -> tuple[str, str]:
+    """(pub_date, pub_time) for a Unix timestamp, e.g. ("2024-01-31", "18:05:09")."""
+    dt = datetime.fromtimestamp(ts)
+    return (
+        f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}",
+        f"{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}",
+    )
+
+
+def build_meta(plays, comments, likes, ts, insta_id) -> dict:
+    """Common metadata dict returned by both the fast path and yt-dlp."""
+    pub_date, pub_time = _fmt_ts(int(ts)) if ts else (None, None)
+
+    return {
+        "plays": plays,
+        "comments": comments,
+        "likes": likes,
+        "pub_date": pub_date,
+        "pub_time": pub_time,
+        "insta_id": insta_id,
+    }
+
+
+def get_instagram_metadata(url: str, cookie_file: str) -> dict:
+    """
+    Fetch metadata for a single Instagram URL using the given cookie file.
+    Raises whatever yt-dlp raises; caller handles retries / error logging.
+    """
+    ydl = _get_ydl(cookie_file)
+    info = ydl.extract_info(url, download=False)
+
+    return build_meta(
+        plays=info.get("view_count"),
+        comments=info.get("comment_count"),
+        likes=info.get("like_count"),
+        ts=info.get("timestamp"),
+        insta_id=info.get("uploader") or info.get("uploader_id"),
+    )
+
+
+# ===========================================================
+# 3. Errors that survive the trip back from a worker process
+# ===========================================================
+class ScrapeError(Exception):
+    """
+    Picklable stand-in for a yt-dlp error: same message, plus the HTTP
+    response headers (lower-cased) if the original error carried any.
+    """
+
+    def __init__(self, message: str, headers: dict | None = None):
+        super().__init__(message)
+        self.headers = headers
+
+
+def error_headers(exc: BaseException):
+    """
+    Find HTTP response headers on an aiohttp error or a yt-dlp DownloadError
+    (whose original HTTPError sits in exc_info / cause).
+    """
+    seen = set()
+    stack = [exc]
+    while stack:
+        err = stack.pop()
+        if err is None or id(err) in seen:
+            continue
+        seen.add(id(err))
+
+        headers = getattr(err, "headers", None)
+        if headers is None:
+            headers = getattr(getattr(err, "response", None), "headers", None)
+        if headers is not None:
+            return headers
+
+        exc_info = getattr(err, "exc_info", None)
+        stack.extend([
+            exc_info[1] if exc_info else None,
+            getattr(err, "cause", None),
+            err.__cause__,
+            err.__context__,
+        ])
+    return None
+
+
+def extract_in_worker(url: str, cookie_file: str) -> dict:
+    """
+    get_instagram_metadata for the process pool. yt-dlp errors hold
+    tracebacks that can't be pickled, so they are re-raised as ScrapeError.
+    """
+    try:
+        return get_instagram_metadata(url, cookie_file)
+    except Exception as e:
+        headers = error_headers(e)
+        if headers is not None:
+            headers = {str(k).lower(): str(v) for k, v in headers.items()}
+        raise ScrapeError(str(e), headers) from None
+
+
+# ===========================================================
+# 4. Process pool – true parallelism for yt-dlp's CPU-bound parsing
+# ===========================================================
+def _usable_cpus() -> int:
+    """CPUs this process may run on (cpu_count where affinity is unavailable)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Worker processes for yt-dlp (0 = use the caller's thread pool only).
+# Capped by default: containers often report the host's cores, and each
+# worker runs one extraction at a time, so a big pool mostly trades away
+# the IO concurrency the caller's thread pool would give.
+YTDLP_MAX_DEFAULT_PROCESSES = 4
+YTDLP_PROCESSES = int(os.environ.get(
+    "YTDLP_PROCESSES", str(min(_usable_cpus(), YTDLP_MAX_DEFAULT_PROCESSES))
+))
+
+_PPOOL: concurrent.futures.ProcessPoolExecutor | None = None
+_PPOOL_LOCK = threading.Lock()
+# Set once the pool could not be started in this process; threads from then on
+_PPOOL_DISABLED = False
+
+
+def _init_worker(cookie_files: tuple[str, ...]):
+    """Runs once in each worker: fresh locks/caches, then warm up yt-dlp."""
+    global _YDL_CACHE_LOCK, _YDL_LOCAL
+    # Locks may have been held by another parent thread at fork time
+    _YDL_CACHE_LOCK = threading.RLock()
+    _YDL_LOCAL = threading.local()
+    _INHERITED_YDL.extend(_YDL_INSTANCES)
+    _YDL_INSTANCES.clear()
+    _COOKIE_JARS.clear()
+
+    for cookie_file in cookie_files:
+        try:
+            _get_ydl(cookie_file)
+        except Exception as e:
+            log.warning("Worker %d could not preload %s: %s", os.getpid(), cookie_file, e)
+
+
+def get_process_pool(cookie_files: tuple[str, ...]) -> concurrent.futures.ProcessPoolExecutor | None:
+    """
+    Shared yt-dlp process pool, created on first use. Lives at module level
+    here so Streamlit reruns reuse it instead of forking new workers.
+    Returns None when YTDLP_PROCESSES is 0, inside daemonic processes (e.g.
+    the forked API_WORKERS, which may not have children) or after
+    disable_process_pool().
+    """
+    global _PPOOL
+    if YTDLP_PROCESSES <= 0 or _PPOOL_DISABLED or multiprocessing.current_process().daemon:
+        return None
+    if _PPOOL is None:
+        with _PPOOL_LOCK:
+            if _PPOOL is None:
+                # fork: spawn/forkserver would re-run the Streamlit script in each worker
+                _PPOOL = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=YTDLP_PROCESSES,
+                    mp_context=multiprocessing.get_context("fork"),
+                    initializer=_init_worker,
+                    initargs=(tuple(cookie_files),),
+                )
+    return _PPOOL
+
+
+def recycle_process_pool(stale: concurrent.futures.ProcessPoolExecutor | None = None):
+    """
+    Drop the current pool (e.g. after cookie rotation or a crashed worker);
+    the next get_process_pool() call starts fresh workers. With `stale`, only
+    drop it if it is still the current pool, so a pool another request has
+    already replaced is left alone.
+    """
+    global _PPOOL
+    with _PPOOL_LOCK:
+        if stale is not None and _PPOOL is not stale:
+            return
+        pool, _PPOOL = _PPOOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=False)
+
+
+def disable_process_pool(reason: BaseException):
+    """Stop using the process pool in this process (it failed to start workers)."""
+    global _PPOOL_DISABLED
+    _PPOOL_DISABLED = True
+    log.warning("yt-dlp process pool disabled (%s); using threads only.", reason)
+    recycle_process_pool()
+
+
+atexit.register(recycle_process_pool)